@@ -61,6 +61,12 @@
 # % description: Assume that the dataset has the same projection as the current location
 # %end
 
+# %flag
+# % key: w
+# % description: Skip if output (raster map or group) already exists in the new mapset
+# % guisection: Optional
+# %end
+
 # %option
 # % key: input
 # % type: string
@@ -149,13 +155,177 @@
 # % guisection: Metadata
 # %end
 
+import atexit
 import os
+import random
+import re
 import shutil
 import subprocess
 import sys
+import tempfile
+from contextlib import contextmanager
 from time import sleep
 import grass.script as grass
 
+try:
+    import fcntl
+except ImportError:
+    # no file locks available (Windows), the server slots are disabled
+    fcntl = None
+
+# exponential backoff with full jitter for retries of r.import, so that
+# parallel workers do not retry against the same remote server in lockstep
+BASE = 2.0
+CAP = 120.0
+
+# options which are passed on to r.import
+FORWARD_OPTIONS = (
+    "input",
+    "band",
+    "memory",
+    "output",
+    "resample",
+    "extent",
+    "resolution",
+    "resolution_value",
+    "title",
+)
+# flags which are passed on to r.import
+FORWARD_FLAGS = ("e", "n", "l", "o")
+
+# region values which can be set with g.region
+REGION_KEYS = ("n", "s", "e", "w", "t", "b", "nsres", "ewres", "tbres")
+
+# host name of a remote input, e.g. /vsicurl/https://<host>/path/file.tif
+URL_HOST = re.compile(r"(?:https?|ftp)://(?:[^/@]*@)?([^/:]+)")
+
+# outcomes of a single r.import run
+SUCCESS = "success"
+NO_OVERLAP = "no_overlap"
+EMPTY = "empty"
+RETRY_TRANSIENT = "retry_transient"
+FATAL = "fatal"
+
+# all messages of r.import which are checked, compiled into one pattern
+PATTERNS = re.compile(
+    r"(?P<no_overlap>does not overlap)"
+    r"|(?P<empty>reprojected raster .* is empty)"
+    r"|(?P<gzip>cpl_vsil_gzip\.cpp)"
+    r"|(?P<http503>\b503\b)"
+    r"|(?P<fatal>ERROR: (?:Unable to open|Projection of dataset does not appear))"
+    r"|(?P<gdal_fatal>ERROR \d+: (?:Unable to open|PROJ|Cannot|Corrupt)"
+    r"|GDAL signalled an error)"
+)
+# pattern groups in order of priority and their outcome; errors are only
+# fatal if no transient error was found, since a failed remote fetch is
+# usually followed by a generic open or read error
+PATTERN_OUTCOMES = (
+    ("no_overlap", NO_OVERLAP),
+    ("empty", EMPTY),
+    ("gzip", RETRY_TRANSIENT),
+    ("http503", RETRY_TRANSIENT),
+    ("fatal", FATAL),
+    ("gdal_fatal", FATAL),
+)
+# number of output lines of r.import which are kept for messages
+MAX_OUTPUT_LINES = 50
+
+
+def classify(found, returncode):
+    """Classifies the result of r.import into one of the outcomes"""
+    if returncode == 0:
+        # a successful run may still have imported nothing
+        if "no_overlap" in found:
+            return NO_OVERLAP
+        if "empty" in found:
+            return EMPTY
+        return SUCCESS
+    for group, outcome in PATTERN_OUTCOMES:
+        if group in found:
+            return outcome
+    # unknown errors are retried
+    return RETRY_TRANSIENT
+
+
+def read_output(cmd):
+    """Waits for r.import and returns the set of found pattern groups and
+    the last lines of its output
+    """
+    resp = cmd.communicate()
+    resp_text = (resp[0] + resp[1]).decode("utf-8", errors="replace")
+    found = {match.lastgroup for match in PATTERNS.finditer(resp_text)}
+    lines = resp_text.splitlines(keepends=True)[-MAX_OUTPUT_LINES:]
+    return found, "".join(lines)
+
+
+def env_int(name, default):
+    """Returns the integer value of an environment variable"""
+    value = os.environ.get(name, str(default))
+    try:
+        return int(value)
+    except ValueError:
+        grass.fatal(
+            _(f"Environment variable {name} has to be an integer, not <{value}>")
+        )
+
+
+def backoff_delay(tries):
+    """Returns a random delay in seconds for the given number of tries"""
+    return random.uniform(0, min(CAP, BASE * (2 ** (tries - 1))))
+
+
+@contextmanager
+def server_slot(input):
+    """Waits for a free slot to access the server of a remote input
+
+    The number of workers importing from the same server at the same time
+    is limited by the environment variable R_IMPORT_WORKER_CONCURRENCY.
+    Local inputs are never throttled.
+    """
+    concurrency = env_int("R_IMPORT_WORKER_CONCURRENCY", 0)
+    match = URL_HOST.search(input)
+    if fcntl is None or concurrency < 1 or not match:
+        yield
+        return
+    # the slots are per user, so that the lock files of other users in the
+    # shared temporary directory never have to be opened
+    slot_dir = os.path.join(
+        tempfile.gettempdir(),
+        f"r_import_worker_sem_{os.getuid()}",
+        match.group(1),
+    )
+    os.makedirs(slot_dir, mode=0o700, exist_ok=True)
+    fd = None
+    for slot in range(concurrency):
+        fd = os.open(os.path.join(slot_dir, str(slot)), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            os.close(fd)
+            fd = None
+    if fd is None:
+        # all slots are busy: wait for a random one to be freed
+        slot = random.randrange(concurrency)
+        fd = os.open(os.path.join(slot_dir, str(slot)), os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def output_exists(output, mapset):
+    """Checks if the output of r.import exists in the mapset, either as
+    raster map or as group for multiple bands
+    """
+    # check the raster map first, the group is only created for multiple bands
+    return bool(
+        grass.find_file(name=output, element="cell", mapset=mapset)["file"]
+        or grass.find_file(name=output, element="group", mapset=mapset)["file"]
+    )
+
 
 def main():
 
@@ -167,6 +337,14 @@ def main():
             GRASS_MESSAGE_FORMAT="plain",
         )
     )
+    # GDAL settings for caching remote data, which can be overwritten by
+    # the user; GDAL_NUM_THREADS and GDAL_CACHEMAX are not set, since several
+    # workers run in parallel and r.in.gdal sets its cache from memory=
+    for key, val in dict(
+        CPL_VSIL_CURL_CACHE_SIZE=str(256 << 20),
+        VSI_CACHE="TRUE",
+    ).items():
+        os.environ.setdefault(key, val)
 
     # actual mapset, location, ...
     env = grass.gisenv()
@@ -175,6 +353,14 @@ def main():
     # old_mapset = env['MAPSET']
 
     new_mapset = options["newmapset"]
+    if flags["w"] and output_exists(options["output"], new_mapset):
+        grass.message(
+            _(
+                f"Output <{options['output']}> already exists in mapset "
+                f"<{new_mapset}>, skipping import"
+            )
+        )
+        return 0
     grass.message(_("New mapset: <%s>" % new_mapset))
     grass.utils.try_rmdir(os.path.join(gisdbase, location, new_mapset))
 
@@ -182,12 +368,22 @@ def main():
     gisrc = os.environ["GISRC"]
     newgisrc = "%s_%s" % (gisrc, str(os.getpid()))
     grass.try_remove(newgisrc)
+    # the file has to be a real copy: g.mapset rewrites the GISRC in place
+    # (truncating it), so a hard link would also change the original GISRC
     shutil.copyfile(gisrc, newgisrc)
     os.environ["GISRC"] = newgisrc
 
+    def cleanup():
+        grass.utils.try_remove(newgisrc)
+        os.environ["GISRC"] = gisrc
+
+    # also clean up if the import fails with grass.fatal or an exception
+    atexit.register(cleanup)
+
     # save region if extent=region
     if options["extent"] == "region":
-        reg = grass.region()
+        cur_reg = grass.region()
+        reg = {key: cur_reg[key] for key in REGION_KEYS if key in cur_reg}
 
     # change mapset
     grass.message(_("GISRC: <%s>" % os.environ["GISRC"]))
@@ -195,56 +391,33 @@ def main():
 
     # set region
     if options["extent"] == "region":
-        del reg["cells"]
-        del reg["rows"]
-        del reg["cols"]
-        del reg["zone"]
-        del reg["projection"]
-        grass.run_command("g.region", **reg, flags="p")
+        grass.run_command("g.region", **reg)
 
     # import data
     grass.message(_("Running r.import ..."))
-    kwargs = dict()
-    for opt, val in options.items():
-        if opt != "newmapset" and val:
-            kwargs[opt] = val
-    if True in flags.values():
-        flagstr = "-"
-    else:
-        flagstr = ""
-    for flag, val in flags.items():
-        if val:
-            flagstr += flag
-    kwargsstr = ""
-    for key, val in kwargs.items():
-        kwargsstr += " %s='%s'" % (key, val)
-    max_tries = 10
+    kwargs = {opt: options[opt] for opt in FORWARD_OPTIONS if options[opt]}
+    flagstr = "".join(flag for flag in FORWARD_FLAGS if flags[flag])
+    argv = ["r.import", "--q"]
+    if flagstr:
+        argv.append(f"-{flagstr}")
+    argv += [f"{key}={val}" for key, val in kwargs.items()]
+    max_tries = env_int("R_IMPORT_WORKER_MAX_TRIES", 10)
     next_try = True
     tries = 0
     noOverlap = False
     while next_try:
         tries += 1
-        cmd = grass.Popen(
-            f"r.import --q {kwargsstr} {flagstr}",
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        resp = cmd.communicate()
-        resp_text = ""
-        for resp_line in resp:
-            resp_text += resp_line.decode("utf-8")
-        if (
-            "\n0..3..6..9..12..15..18..21..24..27..30..33..36..39..42..45..48"
-            "..51..54..57..60..63..66..69..72..75..78..81..84..87..90..93..96"
-            "..99..100\n"
-            in resp_text
-        ):
+        with server_slot(options["input"]):
+            cmd = grass.Popen(
+                argv,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            found, resp_text = read_output(cmd)
+        outcome = classify(found, cmd.returncode)
+        if outcome == SUCCESS:
             next_try = False
-        elif (
-            "Input raster does not overlap current computational region"
-            in resp_text
-        ):
+        elif outcome == NO_OVERLAP:
             grass.warning(
                 _(
                     "Input raster map <%s> does not overlap with current "
@@ -254,10 +427,7 @@ def main():
             )
             next_try = False
             noOverlap = True
-        elif (
-            "The reprojected raster <%s> is empty" % options["output"]
-            in resp_text
-        ):
+        elif outcome == EMPTY:
             grass.warning(
                 _(
                     "Only no-data values found in current region for input "
@@ -265,53 +435,24 @@ def main():
                 )
             )
             next_try = False
-        elif "cpl_vsil_gzip.cpp" in resp_text and tries < max_tries:
-            sleep(10)
-            next_try = True
-            msg = "Retrying %d/%d (%s) ..." % (
-                tries,
-                max_tries,
-                options["input"],
-            )
-            grass.warning(msg)
-        elif "503" in resp_text:
-            msg = resp_text + " (%s)" % options["input"]
-            if tries < max_tries:
-                sleep(10)
-                next_try = True
-                msg += " Retrying %d/%d ..." % (tries, max_tries)
-            else:
-                next_try = False
-            grass.warning(msg)
-        elif resp_text != "":
+        elif outcome == FATAL:
+            grass.fatal(f"{resp_text} ({options['input']})")
+        elif outcome == RETRY_TRANSIENT:
             msg = f"{resp_text} ({options['input']})"
             if tries < max_tries:
-                sleep(10)
+                sleep(backoff_delay(tries))
                 next_try = True
                 msg += f" Retrying {tries}/{max_tries} ..."
             else:
                 next_try = False
             grass.warning(msg)
-        else:
-            next_try = False
 
-    if (
-        not grass.find_file(
-            name=options["output"],
-            element="raster",
-            mapset=options["newmapset"],
-        )["file"]
-        and not grass.find_file(
-            name=options["output"],
-            element="group",
-            mapset=options["newmapset"],
-        )["file"]
-        and noOverlap is not True
-    ):
+    # the check is skipped if nothing was imported on purpose
+    if noOverlap is not True and not output_exists(options["output"], new_mapset):
         grass.fatal(_("ERROR %s" % options["output"]))
 
-    grass.utils.try_remove(newgisrc)
-    os.environ["GISRC"] = gisrc
+    cleanup()
+    atexit.unregister(cleanup)
     return 0
 
 
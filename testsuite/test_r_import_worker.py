@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+#
+############################################################################
+#
+# MODULE:       r.import.worker test
+# AUTHOR(S):    mundialis GmbH & Co. KG
+# PURPOSE:      Tests the classification of the r.import output
+# COPYRIGHT:    (C) 2026 by mundialis GmbH & Co. KG and the GRASS
+#               Development Team
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+############################################################################
+
+import importlib.machinery
+import importlib.util
+import os
+import subprocess
+import sys
+from unittest import mock
+
+from grass.gunittest.case import TestCase
+from grass.gunittest.main import test
+
+
+def load_worker():
+    """Loads r.import.worker.py as module (the name is no valid identifier)"""
+    path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "r.import.worker.py"
+    )
+    loader = importlib.machinery.SourceFileLoader("r_import_worker", path)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+worker = load_worker()
+
+
+class TestRImportWorker(TestCase):
+    def run_output(self, stdout="", stderr="", returncode=0):
+        """Runs a child process with the given output and return code"""
+        code = (
+            "import sys;"
+            f"sys.stdout.write({stdout!r});"
+            f"sys.stderr.write({stderr!r});"
+            f"sys.exit({returncode})"
+        )
+        cmd = subprocess.Popen(
+            [sys.executable, "-c", code],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        found, resp_text = worker.read_output(cmd)
+        return found, resp_text, worker.classify(found, cmd.returncode)
+
+    def test_success(self):
+        """A successful run is not stopped by a recovered HTTP 503"""
+        found, resp_text, outcome = self.run_output(
+            stderr=(
+                "Warning 1: HTTP error code: 503 - https://example.com/x.tif. "
+                "Retrying again in 1.0 secs\n"
+                "0..3..6..9..99..100\n"
+            )
+        )
+        self.assertIn("http503", found)
+        self.assertIn("0..3..6", resp_text)
+        self.assertEqual(outcome, worker.SUCCESS)
+
+    def test_no_overlap(self):
+        """Non-overlapping input is not retried"""
+        _found, _resp_text, outcome = self.run_output(
+            stderr="Input raster does not overlap current computational region\n"
+        )
+        self.assertEqual(outcome, worker.NO_OVERLAP)
+
+    def test_transient(self):
+        """A failed run with HTTP 503 or an unknown error is retried"""
+        _found, _resp_text, outcome = self.run_output(
+            stderr="ERROR 1: HTTP error code: 503\n", returncode=1
+        )
+        self.assertEqual(outcome, worker.RETRY_TRANSIENT)
+        _found, _resp_text, outcome = self.run_output(
+            stderr="something went wrong\n", returncode=1
+        )
+        self.assertEqual(outcome, worker.RETRY_TRANSIENT)
+
+    def test_fatal(self):
+        """A failed run with a permanent error is not retried"""
+        _found, _resp_text, outcome = self.run_output(
+            stderr="ERROR: Projection of dataset does not appear to match\n",
+            returncode=1,
+        )
+        self.assertEqual(outcome, worker.FATAL)
+        _found, _resp_text, outcome = self.run_output(
+            stderr="ERROR 4: Unable to open /data/missing.tif\n", returncode=1
+        )
+        self.assertEqual(outcome, worker.FATAL)
+
+    def test_gdal_error_after_transient(self):
+        """A GDAL error following a transient error is retried"""
+        _found, _resp_text, outcome = self.run_output(
+            stderr=(
+                "ERROR 1: HTTP error code : 503\n"
+                "GDAL signalled an error: err_no=1\n"
+            ),
+            returncode=1,
+        )
+        self.assertEqual(outcome, worker.RETRY_TRANSIENT)
+        _found, _resp_text, outcome = self.run_output(
+            stderr=(
+                "ERROR 1: cpl_vsil_gzip.cpp: inflate() failed\n"
+                "ERROR 1: Cannot read block\n"
+            ),
+            returncode=1,
+        )
+        self.assertEqual(outcome, worker.RETRY_TRANSIENT)
+        _found, _resp_text, outcome = self.run_output(
+            stderr=(
+                "ERROR 1: HTTP error code : 503\n"
+                "ERROR: Unable to open datasource </vsicurl/https://x/y.tif>\n"
+            ),
+            returncode=1,
+        )
+        self.assertEqual(outcome, worker.RETRY_TRANSIENT)
+
+    def test_output_lines(self):
+        """Both pipes are read and only the last lines are kept"""
+        stdout = "".join(f"line {num}\n" for num in range(200))
+        _found, resp_text, _outcome = self.run_output(
+            stdout=stdout, stderr="done\n"
+        )
+        lines = resp_text.splitlines()
+        self.assertEqual(len(lines), worker.MAX_OUTPUT_LINES)
+        self.assertEqual(lines[-1], "done")
+
+    def find_file(self, existing):
+        """Returns a replacement of grass.find_file which finds the given
+        (element, mapset) pairs
+        """
+
+        def find_file(name, element, mapset):
+            found = (element, mapset) in existing
+            return {"file": f"/{mapset}/{element}/{name}" if found else ""}
+
+        return mock.patch.object(
+            worker.grass, "find_file", side_effect=find_file, create=True
+        )
+
+    def test_output_exists(self):
+        """The output exists as raster map or as group"""
+        for existing, exists in (
+            ({("cell", "new")}, True),
+            ({("group", "new")}, True),
+            ({("cell", "other")}, False),
+            (set(), False),
+        ):
+            with self.find_file(existing):
+                self.assertEqual(worker.output_exists("out", "new"), exists)
+
+    def test_skip_existing_output(self):
+        """With -w the import is skipped if the output group exists"""
+        options = {"newmapset": "new", "output": "out", "input": "in.tif"}
+        flags = {"w": True, "e": False, "n": False, "l": False, "o": False}
+        env = {"GISDBASE": "/grassdata", "LOCATION_NAME": "loc"}
+        with self.find_file({("group", "new")}), mock.patch.multiple(
+            worker.grass,
+            gisenv=mock.DEFAULT,
+            message=mock.DEFAULT,
+            run_command=mock.DEFAULT,
+            create=True,
+        ) as grass_mocks, mock.patch.object(
+            worker, "options", options, create=True
+        ), mock.patch.object(
+            worker, "flags", flags, create=True
+        ), mock.patch.dict(
+            os.environ
+        ):
+            grass_mocks["gisenv"].return_value = env
+            self.assertEqual(worker.main(), 0)
+            grass_mocks["run_command"].assert_not_called()
+
+    def test_url_host(self):
+        """The server slots are keyed by the host of a remote input"""
+        for url in (
+            "/vsicurl/https://example.com/data/x.tif",
+            "/vsicurl/https://user:pw@example.com/data/x.tif",
+            "https://example.com:8080/data/x.tif",
+        ):
+            self.assertEqual(worker.URL_HOST.search(url).group(1), "example.com")
+        self.assertIsNone(worker.URL_HOST.search("/data/x.tif"))
+
+
+if __name__ == "__main__":
+    test()